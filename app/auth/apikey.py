@@ -5,11 +5,14 @@ from fastapi.security.api_key import APIKeyHeader
 
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
+# Resolved once at import (app.main loads .env first): fail fast instead of on the first ingest.
+_EXPECTED = os.getenv("INGEST_API_KEY") or None
+if _EXPECTED is None:
+    raise RuntimeError("INGEST_API_KEY not set")
+_EXPECTED_B = _EXPECTED.encode("utf-8")
+
 def require_ingest_key(api_key: str = Security(api_key_header)) -> None:
-    expected = os.getenv("INGEST_API_KEY", "")
-    if not expected:
-        raise RuntimeError("INGEST_API_KEY not set")
     if not api_key:
         raise HTTPException(status_code=401, detail="Missing API key")
-    if not hmac.compare_digest(api_key, expected):
+    if not hmac.compare_digest(api_key.encode("utf-8"), _EXPECTED_B):
         raise HTTPException(status_code=403, detail="Invalid API key")
@@ -1,10 +1,20 @@
 from typing import Optional, Dict
+import base64
+import hashlib
+import json
+import threading
+import time
+from cachetools import TTLCache
 from fastapi import HTTPException, Header
 import firebase_admin
 from firebase_admin import auth
 
 _initialized = False
 
+# sha256(token) -> decoded payload; entries are also checked against the token's own exp.
+_token_cache = TTLCache(maxsize=10000, ttl=300)
+_token_lock = threading.Lock()
+
 def init_firebase():
     global _initialized
     if _initialized:
@@ -13,13 +23,52 @@ def init_firebase():
     firebase_admin.initialize_app()
     _initialized = True
 
+def _b64url(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _warmup_token(project_id: str) -> str:
+    # Unsigned, but with claims that pass firebase_admin's pre-checks so that it
+    # goes on to fetch Google's public certs before rejecting the signature.
+    now = int(time.time())
+    header = {"alg": "RS256", "kid": "warmup", "typ": "JWT"}
+    payload = {
+        "aud": project_id,
+        "iss": f"https://securetoken.google.com/{project_id}",
+        "sub": "warmup",
+        "iat": now,
+        "exp": now + 60,
+    }
+    return ".".join([_b64url(json.dumps(header).encode()), _b64url(json.dumps(payload).encode()), _b64url(b"warmup")])
+
+def warm_firebase() -> None:
+    """Initialize the app and prefetch the ID-token public keys at boot."""
+    init_firebase()
+    project_id = firebase_admin.get_app().project_id
+    if not project_id:
+        return
+    try:
+        auth.verify_id_token(_warmup_token(project_id))
+    except Exception:
+        # Expected: the probe is rejected once the certs have been fetched (and cached).
+        pass
+
 def verify_bearer(authorization: Optional[str] = Header(default=None)) -> Dict:
     init_firebase()
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing bearer token")
     token = authorization.split(" ", 1)[1].strip()
+    key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    with _token_lock:
+        cached = _token_cache.get(key)
+    if cached is not None and cached.get("exp", 0) > time.time():
+        return cached
+
     try:
         decoded = auth.verify_id_token(token)
-        return decoded
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Invalid token: {e}")
+
+    with _token_lock:
+        _token_cache[key] = decoded
+    return decoded
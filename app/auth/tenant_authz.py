@@ -1,5 +1,9 @@
+from dataclasses import dataclass
+from typing import Any, Optional
+import threading
+from cachetools import TTLCache
 from fastapi import HTTPException
-from app.services.firestore import db
+from app.services.firestore import get_db
 
 ROLE_RANK = {
     "farmer": 1,
@@ -9,20 +13,49 @@ ROLE_RANK = {
 
 MULTI_TENANT_ROLES = {"admin", "tech"}
 
+@dataclass(frozen=True)
+class UserAuthz:
+    role: str
+    tenant_single: Any
+    tenant_ids: Any
+
+# Role/tenant membership changes rarely; keep it per process for a short while.
+_user_cache = TTLCache(maxsize=5000, ttl=60)
+_user_lock = threading.Lock()
+
+def _load_user(uid: str) -> Optional[UserAuthz]:
+    """Cached users/{uid} lookup; role/tenant changes take up to 60 s (the cache TTL) to apply."""
+    with _user_lock:
+        cached = _user_cache.get(uid)
+    if cached is not None:
+        return cached
+
+    snap = get_db().collection("users").document(uid).get()
+    if not snap.exists:
+        return None
+
+    data = snap.to_dict() or {}
+    prefs = data.get("preferences") or {}
+    user = UserAuthz(
+        role=(prefs.get("role") or "").strip().lower(),
+        tenant_single=data.get("tenantId"),
+        tenant_ids=data.get("tenantIds"),
+    )
+    with _user_lock:
+        _user_cache[uid] = user
+    return user
+
 def authorize_tenant(tenant_id: str, decoded_token: dict, min_role: str = "farmer") -> str:
     """Authorize access to a tenant using global users/{uid} doc (as per your screenshot)."""
     uid = decoded_token.get("uid")
     if not uid:
         raise HTTPException(status_code=401, detail="Missing uid")
 
-    user_ref = db.collection("users").document(uid)
-    snap = user_ref.get()
-    if not snap.exists:
+    user = _load_user(uid)
+    if user is None:
         raise HTTPException(status_code=403, detail="User profile not found")
 
-    data = snap.to_dict() or {}
-    prefs = data.get("preferences") or {}
-    role = (prefs.get("role") or "").strip().lower()
+    role = user.role
     if role not in ROLE_RANK:
         raise HTTPException(status_code=403, detail="Invalid role")
 
@@ -30,8 +63,8 @@ def authorize_tenant(tenant_id: str, decoded_token: dict, min_role: str = "farme
     if needed not in ROLE_RANK:
         raise HTTPException(status_code=500, detail="Server role config error")
 
-    tenant_single = data.get("tenantId")
-    tenant_ids = data.get("tenantIds")
+    tenant_single = user.tenant_single
+    tenant_ids = user.tenant_ids
 
     is_member = False
     if isinstance(tenant_single, str) and tenant_single == tenant_id:
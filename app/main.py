@@ -1,13 +1,28 @@
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 
+# Before the routers: some modules read their settings at import time.
+load_dotenv()
+
+from app.auth.firebase import warm_firebase
 from app.routers import admin, ingest
 
-load_dotenv()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pay Firebase bootstrap + public-key fetch at boot, not on the first admin request.
+    warm_firebase()
+    yield
 
-app = FastAPI(title="AgroMind Sense API", version="0.1.0")
+app = FastAPI(
+    title="AgroMind Sense API",
+    version="0.1.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 origins = os.getenv("CORS_ORIGINS", "*")
 if origins == "*" or origins.strip() == "":
@@ -1,13 +1,37 @@
 from fastapi import APIRouter, Depends, HTTPException
+from google.api_core.exceptions import AlreadyExists
 from pydantic import BaseModel, ConfigDict
 from typing import List, Optional, Any
+import asyncio
 import hashlib
+import logging
 import time
 
 from app.auth.apikey import require_ingest_key
-from app.services.firestore import db, resolve_hardware, readings_col, sensor_ref, acks_col, normalize_hw
+from app.services.plan_codec import canonical_json_bytes
+from app.services.firestore import SERVER_TIMESTAMP, adb, resolve_hardware_async, readings_col, sensor_ref, acks_col, normalize_hw
 
 router = APIRouter()
+log = logging.getLogger(__name__)
+
+# Static parts of the sensor status merges; handlers only fill in the per-request fields.
+_STATUS_UPDATE = {"updatedAt": SERVER_TIMESTAMP}
+_TELEMETRY_STATUS = {"lastSeenAt": SERVER_TIMESTAMP, "batteryPct": None, "signalDbm": None, "lastGps": None}
+_ACK_STATUS = {"lastAckAt": SERVER_TIMESTAMP, "lastAckOk": None, "lastAckMsg": None}
+
+# Strong refs to in-flight background writes (the event loop only keeps weak ones).
+_bg_tasks: set = set()
+
+def _log_bg_failure(task: asyncio.Task) -> None:
+    _bg_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("background sensor status write failed", exc_info=task.exception())
+
+def fire_and_forget(coro) -> None:
+    """Schedule a write that is not on the caller's correctness path (e.g. sensor status)."""
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_log_bg_failure)
 
 class TelemetryPayload(BaseModel):
     model_config = ConfigDict(extra="allow")
@@ -34,25 +58,30 @@ class AckPayload(BaseModel):
     nv: Optional[int] = None
     nc: Optional[str] = None
 
+def payload_digest(raw: bytes) -> str:
+    return hashlib.sha256(raw).hexdigest()
+
 def compute_bucket_start(t: List[Optional[int]]) -> Optional[int]:
-    ints = [x for x in t if isinstance(x, int)]
-    if len(ints) != len(t) or len(ints) < 2:
+    n = len(t)
+    if n < 2:
         return None
-    step = ints[1] - ints[0]
+    for x in t:
+        if type(x) is not int:
+            return None
+    step = t[1] - t[0]
     if step <= 0 or step > 86400:
         return None
-    period = step * len(ints)
-    last = ints[-1]
-    return last - (last % period)
+    last = t[-1]
+    return last - (last % (step * n))
 
 @router.post("/sensors/telemetry/{hardwareId}")
-def ingest_telemetry(hardwareId: str, payload: TelemetryPayload, _: None = Depends(require_ingest_key)):
+async def ingest_telemetry(hardwareId: str, payload: TelemetryPayload, _: None = Depends(require_ingest_key)):
     hw = normalize_hw(hardwareId)
     if normalize_hw(payload.id) != hw:
         raise HTTPException(status_code=400, detail="hardwareId mismatch (URL vs payload.id)")
 
     try:
-        tenantId, sensorId = resolve_hardware(hw)
+        tenantId, sensorId = await resolve_hardware_async(hw)
     except KeyError:
         raise HTTPException(status_code=404, detail="hardwareId not registered")
 
@@ -61,62 +90,69 @@ def ingest_telemetry(hardwareId: str, payload: TelemetryPayload, _: None = Depen
         now = int(time.time())
         bucket = now - (now % 300)
 
-    raw = payload.model_dump_json()
-    h = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    raw_bytes = canonical_json_bytes(payload.model_dump(mode="json"))
+    h = payload_digest(raw_bytes)
+    raw = raw_bytes.decode("utf-8")
 
     base_id = str(bucket)
-    doc_ref = readings_col(tenantId, sensorId).document(base_id)
-    snap = doc_ref.get()
-    if snap.exists:
-        old = snap.to_dict() or {}
-        if old.get("hash") == h:
-            return {"ok": True, "deduped": True, "readingId": base_id}
-        # Store under a derived id
-        doc_ref = readings_col(tenantId, sensorId).document(f"{base_id}-{h[:8]}")
-
-    doc_ref.set({
-        "receivedAt": db.SERVER_TIMESTAMP,
-        "readingId": doc_ref.id,
+    col = readings_col(tenantId, sensorId, client=adb)
+    doc_ref = col.document(base_id)
+    reading = {
+        "receivedAt": SERVER_TIMESTAMP,
+        "readingId": base_id,
         "bucketStart": bucket,
         "lastTs": payload.t[-1] if payload.t else None,
         "cv": payload.cv,
         "cc": payload.cc,
         "hash": h,
         "payloadRaw": raw,
-    })
+    }
+    try:
+        # Common case: the bucket is new, so a single create() is the only RTT.
+        await doc_ref.create(reading)
+    except AlreadyExists:
+        snap = await doc_ref.get()
+        old = snap.to_dict() or {}
+        if old.get("hash") == h:
+            return {"ok": True, "deduped": True, "readingId": base_id}
+        # Store under a derived id
+        doc_ref = col.document(f"{base_id}-{h[:8]}")
+        reading["readingId"] = doc_ref.id
+        await doc_ref.set(reading)
 
     # Update sensor status
-    sref = sensor_ref(tenantId, sensorId)
-    sref.set({
+    sref = sensor_ref(tenantId, sensorId, client=adb)
+    fire_and_forget(sref.set({
+        **_STATUS_UPDATE,
         "status": {
-            "lastSeenAt": db.SERVER_TIMESTAMP,
+            **_TELEMETRY_STATUS,
             "batteryPct": payload.b,
             "signalDbm": payload.s,
             "lastGps": {"la": payload.la, "lo": payload.lo, "ga": payload.ga} if payload.la is not None and payload.lo is not None else None,
         },
-        "updatedAt": db.SERVER_TIMESTAMP,
-    }, merge=True)
+    }, merge=True))
 
     return {"ok": True, "readingId": doc_ref.id}
 
 @router.post("/sensors/ack/{hardwareId}")
-def ingest_ack(hardwareId: str, payload: AckPayload, _: None = Depends(require_ingest_key)):
+async def ingest_ack(hardwareId: str, payload: AckPayload, _: None = Depends(require_ingest_key)):
     hw = normalize_hw(hardwareId)
     if normalize_hw(payload.id) != hw:
         raise HTTPException(status_code=400, detail="hardwareId mismatch (URL vs payload.id)")
 
     try:
-        tenantId, sensorId = resolve_hardware(hw)
+        tenantId, sensorId = await resolve_hardware_async(hw)
     except KeyError:
         raise HTTPException(status_code=404, detail="hardwareId not registered")
 
-    raw = payload.model_dump_json()
-    h = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    raw_bytes = canonical_json_bytes(payload.model_dump(mode="json"))
+    h = payload_digest(raw_bytes)
+    raw = raw_bytes.decode("utf-8")
     now = int(time.time())
     ack_id = f"{now}-{h[:8]}"
 
-    acks_col(tenantId, sensorId).document(ack_id).set({
-        "receivedAt": db.SERVER_TIMESTAMP,
+    await acks_col(tenantId, sensorId, client=adb).document(ack_id).set({
+        "receivedAt": SERVER_TIMESTAMP,
         "hash": h,
         "payloadRaw": raw,
         "nv": payload.nv,
@@ -125,9 +161,9 @@ def ingest_ack(hardwareId: str, payload: AckPayload, _: None = Depends(require_i
     })
 
     # Update sensor status
-    sensor_ref(tenantId, sensorId).set({
-        "status": {"lastAckAt": db.SERVER_TIMESTAMP, "lastAckOk": payload.ok, "lastAckMsg": payload.m},
-        "updatedAt": db.SERVER_TIMESTAMP,
-    }, merge=True)
+    fire_and_forget(sensor_ref(tenantId, sensorId, client=adb).set({
+        **_STATUS_UPDATE,
+        "status": {**_ACK_STATUS, "lastAckOk": payload.ok, "lastAckMsg": payload.m},
+    }, merge=True))
 
     return {"ok": True, "ackId": ack_id}
@@ -1,7 +1,28 @@
 from google.cloud import firestore
+from cachetools import TTLCache
+import itertools
+import os
 import secrets
+import threading
 
-db = firestore.Client()
+# A single sync client funnels every RPC through one gRPC channel; spread admin
+# traffic over a few of them. `db` stays as the default for one-off callers.
+_POOL_SIZE = max(1, int(os.getenv("FIRESTORE_POOL_SIZE", "4")))
+_clients = [firestore.Client() for _ in range(_POOL_SIZE)]
+_client_cycle = itertools.cycle(_clients)
+db = _clients[0]
+adb = firestore.AsyncClient()
+
+# Module-level sentinel (the Client instances don't carry it).
+SERVER_TIMESTAMP = firestore.SERVER_TIMESTAMP
+
+def get_db() -> firestore.Client:
+    """Round-robin pick from the client pool; use the same client for a whole request."""
+    return next(_client_cycle)
+
+# hardwareIndex rows are effectively immutable once provisioned; the TTL only allows eventual rotation.
+_hw_cache = TTLCache(maxsize=50_000, ttl=3600)
+_hw_lock = threading.Lock()
 
 def normalize_hw(hw: str) -> str:
     return hw.strip().upper()
@@ -10,24 +31,36 @@ def generate_hw_id() -> str:
     # 24-bit random -> 6 hex (uppercase)
     return f"{secrets.randbelow(1<<24):06X}"
 
-def hardware_index_ref(hardware_id: str):
-    return db.collection("hardwareIndex").document(normalize_hw(hardware_id))
+def hardware_index_ref(hardware_id: str, client=None):
+    return (client or db).collection("hardwareIndex").document(normalize_hw(hardware_id))
 
-def resolve_hardware(hardware_id: str) -> tuple[str, str]:
-    snap = hardware_index_ref(hardware_id).get()
+def _cached_hardware(hardware_id: str):
+    with _hw_lock:
+        return _hw_cache.get(normalize_hw(hardware_id))
+
+def _remember_hardware(hardware_id: str, snap) -> tuple[str, str]:
     if not snap.exists:
         raise KeyError("hardwareId not found")
     d = snap.to_dict() or {}
-    return d["tenantId"], d["sensorId"]
+    resolved = (d["tenantId"], d["sensorId"])
+    with _hw_lock:
+        _hw_cache[normalize_hw(hardware_id)] = resolved
+    return resolved
+
+async def resolve_hardware_async(hardware_id: str) -> tuple[str, str]:
+    cached = _cached_hardware(hardware_id)
+    if cached is not None:
+        return cached
+    return _remember_hardware(hardware_id, await hardware_index_ref(hardware_id, client=adb).get())
 
-def sensor_ref(tenant_id: str, sensor_id: str):
-    return db.collection("tenants").document(tenant_id).collection("sensors").document(sensor_id)
+def sensor_ref(tenant_id: str, sensor_id: str, client=None):
+    return (client or db).collection("tenants").document(tenant_id).collection("sensors").document(sensor_id)
 
-def configs_col(tenant_id: str, sensor_id: str):
-    return sensor_ref(tenant_id, sensor_id).collection("configs")
+def configs_col(tenant_id: str, sensor_id: str, client=None):
+    return sensor_ref(tenant_id, sensor_id, client).collection("configs")
 
-def readings_col(tenant_id: str, sensor_id: str):
-    return sensor_ref(tenant_id, sensor_id).collection("readings")
+def readings_col(tenant_id: str, sensor_id: str, client=None):
+    return sensor_ref(tenant_id, sensor_id, client).collection("readings")
 
-def acks_col(tenant_id: str, sensor_id: str):
-    return sensor_ref(tenant_id, sensor_id).collection("acks")
+def acks_col(tenant_id: str, sensor_id: str, client=None):
+    return sensor_ref(tenant_id, sensor_id, client).collection("acks")
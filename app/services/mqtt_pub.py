@@ -1,14 +1,34 @@
 import os
+import threading
+from typing import List, Tuple, Union
 import paho.mqtt.client as mqtt
 
-def publish_retained(topic: str, payload: str, qos: int = 1, timeout_s: int = 5) -> None:
-    host = os.getenv("MQTT_HOST", "188.26.214.67")
-    port = int(os.getenv("MQTT_PORT", "1883"))
-    client_id = os.getenv("MQTT_CLIENT_ID_PREFIX", "sense-api")
-    c = mqtt.Client(client_id=client_id)
-    c.connect(host, port, keepalive=20)
-    c.loop_start()
-    info = c.publish(topic, payload=payload, qos=qos, retain=True)
-    info.wait_for_publish(timeout=timeout_s)
-    c.loop_stop()
-    c.disconnect()
+Payload = Union[bytes, str]
+
+_client = None
+_client_lock = threading.Lock()
+
+def _get_client() -> mqtt.Client:
+    global _client
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is None:
+            host = os.getenv("MQTT_HOST", "188.26.214.67")
+            port = int(os.getenv("MQTT_PORT", "1883"))
+            prefix = os.getenv("MQTT_CLIENT_ID_PREFIX", "sense-api")
+            # One connection per worker process: a shared id would make workers kick each other.
+            c = mqtt.Client(client_id=f"{prefix}-{os.getpid()}")
+            # The network loop reconnects on its own, backing off from 1s up to 30s.
+            c.reconnect_delay_set(min_delay=1, max_delay=30)
+            c.connect(host, port, keepalive=20)
+            c.loop_start()
+            _client = c
+    return _client
+
+def publish_retained_many(msgs: List[Tuple[str, Payload, int]], timeout_s: int = 5) -> None:
+    """Publish several retained messages back-to-back, then wait for all of them (in order)."""
+    c = _get_client()
+    infos = [c.publish(topic, payload=payload, qos=qos, retain=True) for topic, payload, qos in msgs]
+    for info in infos:
+        info.wait_for_publish(timeout=timeout_s)
@@ -1,8 +1,17 @@
 import orjson
 import zlib
+import zstandard
 
 def canonical_json_bytes(obj: dict) -> bytes:
     return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
 
 def crc32_hex(data: bytes) -> str:
     return f"{zlib.crc32(data) & 0xFFFFFFFF:08x}"
+
+PLAN_CODEC = "zstd"
+
+def compress_plan(data: bytes) -> bytes:
+    return zstandard.compress(data, 5)
+
+def decompress_plan(blob: bytes) -> bytes:
+    return zstandard.decompress(blob)
@@ -11,6 +11,9 @@ MAX_REGS_PER_STEP = 32
 
 DecodeType = Literal["u16","s16","u32be","s32be","f32be"]
 
+# Registers consumed by each decode type
+DECODE_REGS = {"u16": 1, "s16": 1, "u32be": 2, "s32be": 2, "f32be": 2}
+
 class Channel(BaseModel):
     model_config = ConfigDict(extra="ignore")
     gpio: int
@@ -80,15 +83,14 @@ def validate_plan(obj: dict) -> Plan:
     for st in p.steps:
         if st.ch < 0 or st.ch >= CHANNEL_COUNT:
             raise ValueError("step.ch out of range")
-        mb = st.modbus
-        if mb.count <= 0 or mb.count > MAX_REGS_PER_STEP:
+        count = st.modbus.count
+        if count <= 0 or count > MAX_REGS_PER_STEP:
             raise ValueError("modbus.count out of range")
         if len(st.decode) == 0 or len(st.decode) > MAX_DECODE:
             raise ValueError("decode list size out of range")
         for d in st.decode:
-            if d.idx < 0 or d.idx >= field_count:
+            if not 0 <= d.idx < field_count:
                 raise ValueError("decode.idx out of range")
-            need = 2 if d.type in ("u32be","s32be","f32be") else 1
-            if d.reg_ofs < 0 or (d.reg_ofs + need) > mb.count:
+            if d.reg_ofs < 0 or (d.reg_ofs + DECODE_REGS[d.type]) > count:
                 raise ValueError("decode.reg_ofs out of range")
     return p
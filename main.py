@@ -1,25 +1,62 @@
-from fastapi import FastAPI, HTTPException, Depends, Query, Header
+from fastapi import FastAPI, HTTPException, Depends, Query, Header, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any, Tuple
+from typing import Optional, List, Dict, Any, Tuple, DefaultDict, Callable, AsyncIterator, Set
 from datetime import datetime, timezone, timedelta
+import asyncio
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from types import MappingProxyType
+from collections import defaultdict
+import logging
 import os
+import re
 
+from aiolimiter import AsyncLimiter
+from cachetools import LRUCache, TLRUCache, TTLCache
+import msgspec
+import orjson
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore, firestore_async
+from google.api_core.exceptions import GoogleAPICallError
+from google.cloud.firestore_v1.bulk_writer import BulkWriteFailure, BulkWriter, BulkWriterOptions
+from google.cloud.firestore_v1.field_path import FieldPath
 
 
+logger = logging.getLogger(__name__)
+
 # ---------- CONFIG ----------
 API_KEY = os.getenv("AGROMIND_API_KEY", "iC6919i3f88i342Q")
 
 SAMPLE_INTERVAL_SEC_DEFAULT = 900
 SAMPLES_PER_BATCH_DEFAULT = 4
 RAW_RETENTION_DAYS = int(os.getenv("RAW_RETENTION_DAYS", "60"))
+# Copia la meta del batch (deviceId, batería, señal, posición, intervalo, typeCode) en cada
+# lectura. Por defecto no: vive en el status del device/sensor y solo inflaría cada escritura.
+EMBED_META_PER_READING = os.getenv("EMBED_META_PER_READING", "0").lower() in ("1", "true", "yes")
+
+# Techo recomendado de escrituras/s en Firestore; compartido por todos los handlers del worker.
+MAX_WRITES_PER_SEC = int(os.getenv("FIRESTORE_MAX_WRITES_PER_SEC", "10000"))
+
+# dailyAgg se aplica en segundo plano cada DAILY_AGG_FLUSH_SEC o al acumular DAILY_AGG_MAX_PENDING lecturas.
+DAILY_AGG_FLUSH_SEC = float(os.getenv("DAILY_AGG_FLUSH_SEC", "1.5"))
+DAILY_AGG_MAX_PENDING = int(os.getenv("DAILY_AGG_MAX_PENDING", "1000"))
+# Los deltas fallidos se reintentan con backoff exponencial (sin límite de intentos). Si se
+# acumulan DAILY_AGG_MAX_BUFFERED lecturas sin aplicar, el ingest responde 503.
+DAILY_AGG_RETRY_BASE_SEC = 2.0
+DAILY_AGG_RETRY_MAX_SEC = 300.0
+DAILY_AGG_MAX_BUFFERED = int(os.getenv("DAILY_AGG_MAX_BUFFERED", "100000"))
 
 MAX_SCHEDULE = 4
 MAX_ITEMS_PER_BATCH = 4
 MAX_SAMPLES_PER_ITEM = 48
 
-RANGE_MAP = {
+ONE_DAY = timedelta(days=1)
+RAW_RETENTION = timedelta(days=RAW_RETENTION_DAYS)
+
+RANGE_MAP = MappingProxyType({
     "1h": timedelta(hours=1),
     "6h": timedelta(hours=6),
     "12h": timedelta(hours=12),
@@ -29,17 +66,44 @@ RANGE_MAP = {
     "3m": timedelta(days=90),
     "6m": timedelta(days=180),
     "1y": timedelta(days=365),
-}
+})
 
 
 # ---------- FIREBASE ----------
 cred = credentials.Certificate("firebase-account.json")
 firebase_admin.initialize_app(cred)
-db = firestore.client()
+# Cliente async: los handlers son `async def` y no bloquean el event loop en cada RPC.
+# Un único cliente por proceso (firestore_async.client() lo cachea por app) con un único
+# canal gRPC: HTTP/2 multiplexa las RPCs concurrentes, incluidos los streams largos de
+# mantenimiento. Todo el módulo usa `db`; no crear clientes dentro de los handlers.
+db = firestore_async.client()
+
+# BulkWriter es API síncrona (hilos propios + time.sleep para su rampa 500/50/5), así que
+# usa el cliente sync y se ejecuta fuera del event loop con asyncio.to_thread.
+sync_db = firestore.client()
+
+BULK_MAX_ATTEMPTS = 5
+
+_write_limiter = AsyncLimiter(MAX_WRITES_PER_SEC, 1)
+
+
+async def throttle_writes(n: int = 1) -> None:
+    """Espera hasta que el limitador admita `n` escrituras más (commit de batch = len(batch))."""
+    await _write_limiter.acquire(min(n, MAX_WRITES_PER_SEC))
 
 
 # ---------- FASTAPI ----------
-app = FastAPI(title="AgroMind Telemetry API")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    daily_agg_combiner.start()
+    try:
+        yield
+    finally:
+        # Aplica lo que quede pendiente antes de cerrar el worker.
+        await daily_agg_combiner.stop()
+
+
+app = FastAPI(title="AgroMind Telemetry API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 
 @app.get("/")
@@ -57,17 +121,235 @@ def verify_api_key(
         raise HTTPException(status_code=401, detail="API key inválida")
 
 
+# ("set" | "delete", ref, data). Los "set" siempre van con merge=True.
+WriteOp = Tuple[str, Any, Optional[Dict[str, Any]]]
+
+
+def _bulk_write_sync(ops: List[WriteOp]) -> List[str]:
+    failures: List[str] = []
+
+    def on_error(err: BulkWriteFailure, _bw: BulkWriter) -> bool:
+        if err.attempts < BULK_MAX_ATTEMPTS:
+            return True
+        failures.append(f"{err.operation.reference.path}: {err.message}")
+        return False
+
+    bw = sync_db.bulk_writer(options=BulkWriterOptions(initial_ops_per_second=500, max_ops_per_second=MAX_WRITES_PER_SEC))
+    bw.on_write_error(on_error)
+    for op, ref, data in ops:
+        if op == "delete":
+            bw.delete(ref)
+        else:
+            bw.set(ref, data, merge=True)
+    bw.close()
+    return failures
+
+
+async def bulk_write(ops: List[WriteOp]) -> List[str]:
+    """Escrituras independientes en paralelo con reintentos; devuelve las que fallaron definitivamente."""
+    # Ocupa un hilo del executor durante toda la escritura: solo para mantenimiento (purga).
+    await throttle_writes(len(ops))
+    return await asyncio.to_thread(_bulk_write_sync, ops)
+
+
+async def batch_write(ops: List[WriteOp]) -> List[str]:
+    """Un único WriteBatch async (atómico, máx. 500 ops); si el commit falla, fallan todas."""
+    await throttle_writes(len(ops))
+    batch = db.batch()
+    for op, ref, data in ops:
+        if op == "delete":
+            batch.delete(ref)
+        else:
+            batch.set(ref, data, merge=True)
+    try:
+        await batch.commit()
+    except GoogleAPICallError as e:
+        return [f"{ref.path}: {e}" for _op, ref, _data in ops]
+    return []
+
+
+# Con pocas escrituras el WriteBatch no aporta nada: van en paralelo.
+DIRECT_WRITE_MAX_OPS = 3
+
+
+async def direct_write(ops: List[WriteOp]) -> List[str]:
+    """Como `batch_write`, pero sin lote: `set()` en paralelo con `asyncio.gather` (para lotes pequeños)."""
+    await throttle_writes(len(ops))
+    results = await asyncio.gather(
+        *(ref.delete() if op == "delete" else ref.set(data, merge=True) for op, ref, data in ops),
+        return_exceptions=True,
+    )
+    return [f"{ref.path}: {res}" for (_op, ref, _data), res in zip(ops, results) if isinstance(res, Exception)]
+
+
 # ---------- HELPERS ----------
-def get_time_window(range_key: str):
-    if range_key not in RANGE_MAP:
+@lru_cache(maxsize=16)
+def _window_start(delta: timedelta, minute: datetime) -> datetime:
+    return minute - delta
+
+
+def get_time_window(range_key: str, now: Optional[datetime] = None):
+    delta = RANGE_MAP.get(range_key)
+    if delta is None:
         raise HTTPException(status_code=400, detail="Rango de tiempo no válido")
-    now = datetime.now(timezone.utc)
-    start = now - RANGE_MAP[range_key]
-    return start, now
+    if now is None:
+        now = datetime.now(timezone.utc)
+    # El inicio se redondea al minuto (ventana hasta 59 s más amplia) y se reutiliza;
+    # el fin sigue siendo `now` para no perder las lecturas más recientes.
+    return _window_start(delta, now.replace(second=0, microsecond=0)), now
+
+
+def _json_default(o: Any) -> Any:
+    # orjson no serializa subclases de datetime (DatetimeWithNanoseconds de Firestore).
+    if isinstance(o, datetime):
+        return o.isoformat()
+    return jsonable_encoder(o)
+
+
+# Respuestas GET ya serializadas, por (endpoint, tenant, sensor, generación, parámetros).
+# El TTL depende de lo rápido que cambia la ventana pedida.
+RESPONSE_TTL_SEC = {"1h": 5, "6h": 30, "12h": 30, "1d": 60, "1w": 300}
+RESPONSE_TTL_SEC_DEFAULT = 600
+DAILY_AGG_RESPONSE_TTL_SEC = 60
+
+# Presupuesto en bytes, no en entradas: un cuerpo de 5000 lecturas ronda 1 MB. Los cuerpos
+# mayores que RESPONSE_CACHE_MAX_ITEM_BYTES no se guardan.
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ITEM_BYTES = 1024 * 1024
+_response_cache: TLRUCache = TLRUCache(
+    maxsize=RESPONSE_CACHE_MAX_BYTES,
+    ttu=lambda _k, v, now: now + v[0],
+    getsizeof=lambda v: len(v[1]),
+)
+# Al ingerir se incrementa la generación del sensor y sus entradas dejan de coincidir.
+_response_gen: Dict[Tuple[str, str], int] = {}
+
+
+def response_gen(tenant_id: str, sensor_id: str) -> int:
+    return _response_gen.get((tenant_id, sensor_id), 0)
+
+
+def invalidate_sensor_responses(tenant_id: str, sensor_id: str) -> None:
+    _response_gen[(tenant_id, sensor_id)] = response_gen(tenant_id, sensor_id) + 1
+
+
+def cached_response(key: Tuple[Any, ...]) -> Optional[Response]:
+    hit = _response_cache.get(key)
+    if hit is None:
+        return None
+    return Response(content=hit[1], media_type="application/json")
+
+
+async def _next_doc(it: AsyncIterator[Any]) -> Any:
+    try:
+        return await it.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def _stream_items(
+    head: Dict[str, Any],
+    first: Any,
+    rest: AsyncIterator[Any],
+    cache_key: Optional[Tuple[Any, ...]],
+    ttl: float,
+    row: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]],
+) -> AsyncIterator[bytes]:
+    # `{...head, "items": [...]}` documento a documento, sin materializar la lista.
+    chunks: Optional[List[bytes]] = [] if cache_key is not None else None
+    size = 0
+    chunk = orjson.dumps(head, default=_json_default)[:-1] + b',"items":['
+    sep = b""
+    s = first
+    while s is not None:
+        d = s.to_dict() or {}
+        if row is not None:
+            d = row(d)
+        chunk += sep + orjson.dumps({"id": s.id, **d}, default=_json_default)
+        sep = b","
+        if chunks is not None:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > RESPONSE_CACHE_MAX_ITEM_BYTES:
+                chunks = None
+        yield chunk
+        chunk = b""
+        s = await _next_doc(rest)
+    chunk += b"]}"
+    if chunks is not None:
+        chunks.append(chunk)
+        _response_cache[cache_key] = (ttl, b"".join(chunks))
+    yield chunk
+
+
+async def stream_items(
+    head: Dict[str, Any],
+    query,
+    cache_key: Optional[Tuple[Any, ...]] = None,
+    ttl: float = 0,
+    row: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+) -> StreamingResponse:
+    # El primer documento se pide antes de responder: si la consulta falla al arrancar
+    # (UNAVAILABLE, índice, permisos...) sale como error normal y no como un 200 cortado.
+    rest = query.stream()
+    first = await _next_doc(rest)
+    return StreamingResponse(_stream_items(head, first, rest, cache_key, ttl, row), media_type="application/json")
+
+
+READINGS_FIELDS = ("ts", "values")
+DAILY_AGG_FIELDS = ("day", "metrics")
+
+
+def readings_projection(select: List[str]) -> List[str]:
+    # Añade los campos literales `values.<k>` a lo que se pida de `values`.
+    out = []
+    for f in select:
+        out.append(f)
+        if f == "values":
+            out.extend(LEGACY_VALUE_FIELDS.values())
+        elif f.startswith("values.") and f[7:] in LEGACY_VALUE_FIELDS:
+            out.append(LEGACY_VALUE_FIELDS[f[7:]])
+    return out
+
+
+# Segmentos identificador separados por punto (sin comillas ni comodines).
+_FIELD_PATH_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*")
+
+
+def fold_legacy_values(d: Dict[str, Any]) -> Dict[str, Any]:
+    # Ambos formatos salen igual: los `values.<k>` literales se devuelven dentro de `values`.
+    legacy = [k for k in d if k.startswith("values.")]
+    if legacy:
+        values = dict(d.get("values") or {})
+        for k in legacy:
+            values[k[7:]] = d.pop(k)
+        d["values"] = values
+    return d
+
+
+def parse_fields(fields: Optional[str], allowed: Tuple[str, ...]) -> List[str]:
+    # `fields` solo puede reducir la proyección por defecto: campos permitidos o sub-campos
+    # (p. ej. `values.vwc_percent`), nunca `seen`/`meta`/`expiresAt`.
+    if not fields:
+        return list(allowed)
+    out: List[str] = []
+    # Ordenados, un campo va justo detrás de su padre: se descartan duplicados y sub-campos
+    # ya cubiertos, que Firestore rechaza en la proyección.
+    for f in sorted({f.strip() for f in fields.split(",")} - {""}):
+        if not _FIELD_PATH_RE.fullmatch(f):
+            raise HTTPException(status_code=400, detail=f"Campo no válido: {f}")
+        if not any(f == a or f.startswith(a + ".") for a in allowed):
+            raise HTTPException(status_code=400, detail=f"Campo no permitido: {f}")
+        if out and f.startswith(out[-1] + "."):
+            continue
+        out.append(f)
+    return out or list(allowed)
 
 
-def day_id(dt: datetime) -> str:
-    return dt.strftime("%Y%m%d")
+async def first_doc(query):
+    async for s in query.limit(1).stream():
+        return s
+    return None
 
 
 def day_start_utc(dt: datetime) -> datetime:
@@ -88,18 +370,26 @@ class TelemetryConfigOut(BaseModel):
 
 
 # ---------- MODELOS (INGEST COMPACT) ----------
-class CompactBatchItem(BaseModel):
-    t: int = Field(..., description="typeCode int (1..9)")
-    s: List[Any] = Field(..., description="samples compactos (números o arrays)")
+# msgspec parsea y valida el JSON en una sola pasada en C, sin dict intermedio.
+# Inmutables: la ruta de ingest solo los lee. Los campos desconocidos se ignoran.
+# gc=False: vienen de JSON y no pueden formar ciclos, así que el GC no los rastrea.
+class CompactBatchItem(msgspec.Struct, frozen=True, gc=False):
+    t: int        # typeCode int (1..9)
+    s: List[Any]  # samples compactos (números o arrays)
+
+
+class CompactBatchTelemetry(msgspec.Struct, frozen=True, gc=False):
+    i: str                     # deviceId
+    it: List[CompactBatchItem]  # items por sensor (máx 4)
+    b: Optional[int] = None    # battery*10 (0..1000)
+    s: Optional[int] = None    # signal dBm*10 (negativo)
+    iv: Optional[int] = None   # intervalSec real del batch
+    la: Optional[int] = None   # lat * 1e6 (int)
+    lo: Optional[int] = None   # lon * 1e6 (int)
+
 
-class CompactBatchTelemetry(BaseModel):
-    i: str = Field(..., description="deviceId")
-    b: Optional[int] = Field(None, description="battery*10 (0..1000)")
-    s: Optional[int] = Field(None, description="signal dBm*10 (negativo)")
-    iv: Optional[int] = Field(None, description="intervalSec real del batch")
-    la: Optional[int] = Field(None, description="lat * 1e6 (int)")
-    lo: Optional[int] = Field(None, description="lon * 1e6 (int)")
-    it: List[CompactBatchItem] = Field(..., description="items por sensor (máx 4)")
+# strict=False: mismas coerciones que aceptaba pydantic ("871" -> 871, 2.0 -> 2).
+_batch_decoder = msgspec.json.Decoder(CompactBatchTelemetry, strict=False)
 
 
 # ---------- TYPE MAP / PARSER ----------
@@ -110,169 +400,242 @@ class CompactBatchTelemetry(BaseModel):
 # - leaf: [wet(0/1), wd(sec), m10] => m10/10
 # - ORP: mV entero
 # - tension: 0.1kPa => /10
-def values_from_compact(type_code: int, sample: Any) -> Dict[str, float]:
-    # Type 1: NPK => [n,p,k] enteros
-    if type_code == 1:
-        if not (isinstance(sample, list) and len(sample) == 3):
-            raise HTTPException(400, detail="type=1 (npk) espera [n,p,k]")
-        return {
-            "nitrogen_mgkg": float(sample[0]),
-            "phosphorus_mgkg": float(sample[1]),
-            "potassium_mgkg": float(sample[2]),
-        }
+def _unwrap1(sample: List[Any], msg: str) -> Any:
+    if len(sample) != 1:
+        raise HTTPException(400, detail=msg)
+    return sample[0]
 
-    # Type 2: soil moisture => v
-    if type_code == 2:
-        if isinstance(sample, list):
-            if len(sample) != 1:
-                raise HTTPException(400, detail="type=2 (soil) espera v o [v]")
-            sample = sample[0]
-        return {"vwc_percent": float(sample)}
-
-    # Type 3: fert => [ecX, stX]
-    if type_code == 3:
-        if not (isinstance(sample, list) and len(sample) == 2):
-            raise HTTPException(400, detail="type=3 (fert) espera [ec,st]")
-        return {
-            "ec_mscm": float(sample[0]) / 100.0,
-            "solution_temp_c": float(sample[1]) / 10.0
-        }
 
-    # Type 4: hygro => [at10, rh10]
-    if type_code == 4:
-        if not (isinstance(sample, list) and len(sample) == 2):
-            raise HTTPException(400, detail="type=4 (hygro) espera [at10,rh10]")
-        return {
-            "air_temp_c": float(sample[0]) / 10.0,
-            "rh_percent": float(sample[1]) / 10.0
-        }
+# Cada decoder valida la forma en línea y devuelve el dict ya con sus claves;
+# el caso común (escalar / array del tamaño justo) no hace llamadas auxiliares.
 
-    # Type 5: leaf => [wet(0/1), wd(sec), m10]
-    if type_code == 5:
-        if not (isinstance(sample, list) and len(sample) == 3):
-            raise HTTPException(400, detail="type=5 (leaf) espera [wet,wd,m10]")
-        wet = 1.0 if int(sample[0]) != 0 else 0.0
-        return {
-            "wet": wet,
-            "wet_duration_s": float(sample[1]),
-            "leaf_moist_pct": float(sample[2]) / 10.0
-        }
+# Type 1: NPK => [n,p,k] enteros
+def _decode_npk(sample: Any) -> Dict[str, float]:
+    if not (isinstance(sample, list) and len(sample) == 3):
+        raise HTTPException(400, detail="type=1 (npk) espera [n,p,k]")
+    n, p, k = sample
+    return {"nitrogen_mgkg": float(n), "phosphorus_mgkg": float(p), "potassium_mgkg": float(k)}
 
-    # Type 6: rain => [rX, riX]
-    if type_code == 6:
-        if not (isinstance(sample, list) and len(sample) == 2):
-            raise HTTPException(400, detail="type=6 (rain) espera [r,ri]")
-        return {
-            "rainfall_mm": float(sample[0]) / 10.0,
-            "intensity_mm_h": float(sample[1]) / 10.0
-        }
 
-    # Type 7: thermal => tt10
-    if type_code == 7:
-        if isinstance(sample, list):
-            if len(sample) != 1:
-                raise HTTPException(400, detail="type=7 (thermal) espera tt o [tt]")
-            sample = sample[0]
-        return {"temperature_c": float(sample) / 10.0}
-
-    # Type 8: ORP mV entero
-    if type_code == 8:
-        if isinstance(sample, list):
-            if len(sample) != 1:
-                raise HTTPException(400, detail="type=8 (orp) espera mv o [mv]")
-            sample = sample[0]
-        return {"orp_mv": float(sample)}
-
-    # Type 9: Soil tension (0.1kPa) => kPa
-    if type_code == 9:
-        if isinstance(sample, list):
-            if len(sample) != 1:
-                raise HTTPException(400, detail="type=9 (tension) espera x o [x]")
-            sample = sample[0]
-        return {"tension_kpa": float(sample) / 10.0}
-
-    raise HTTPException(status_code=400, detail=f"type no soportado: {type_code}")
+# Type 2: soil moisture => v
+def _decode_soil(sample: Any) -> Dict[str, float]:
+    if isinstance(sample, list):
+        sample = _unwrap1(sample, "type=2 (soil) espera v o [v]")
+    return {"vwc_percent": float(sample)}
+
+
+# Type 3: fert => [ecX, stX]
+def _decode_fert(sample: Any) -> Dict[str, float]:
+    if not (isinstance(sample, list) and len(sample) == 2):
+        raise HTTPException(400, detail="type=3 (fert) espera [ec,st]")
+    ec, st = sample
+    return {"ec_mscm": float(ec) / 100.0, "solution_temp_c": float(st) / 10.0}
+
+
+# Type 4: hygro => [at10, rh10]
+def _decode_hygro(sample: Any) -> Dict[str, float]:
+    if not (isinstance(sample, list) and len(sample) == 2):
+        raise HTTPException(400, detail="type=4 (hygro) espera [at10,rh10]")
+    at, rh = sample
+    return {"air_temp_c": float(at) / 10.0, "rh_percent": float(rh) / 10.0}
+
+
+# Type 5: leaf => [wet(0/1), wd(sec), m10]
+def _decode_leaf(sample: Any) -> Dict[str, float]:
+    if not (isinstance(sample, list) and len(sample) == 3):
+        raise HTTPException(400, detail="type=5 (leaf) espera [wet,wd,m10]")
+    wet, wd, m = sample
+    return {
+        "wet": 1.0 if int(wet) != 0 else 0.0,
+        "wet_duration_s": float(wd),
+        "leaf_moist_pct": float(m) / 10.0,
+    }
+
+
+# Type 6: rain => [rX, riX]
+def _decode_rain(sample: Any) -> Dict[str, float]:
+    if not (isinstance(sample, list) and len(sample) == 2):
+        raise HTTPException(400, detail="type=6 (rain) espera [r,ri]")
+    r, ri = sample
+    return {"rainfall_mm": float(r) / 10.0, "intensity_mm_h": float(ri) / 10.0}
+
+
+# Type 7: thermal => tt10
+def _decode_thermal(sample: Any) -> Dict[str, float]:
+    if isinstance(sample, list):
+        sample = _unwrap1(sample, "type=7 (thermal) espera tt o [tt]")
+    return {"temperature_c": float(sample) / 10.0}
+
+
+# Type 8: ORP mV entero
+def _decode_orp(sample: Any) -> Dict[str, float]:
+    if isinstance(sample, list):
+        sample = _unwrap1(sample, "type=8 (orp) espera mv o [mv]")
+    return {"orp_mv": float(sample)}
+
+
+# Type 9: Soil tension (0.1kPa) => kPa
+def _decode_tension(sample: Any) -> Dict[str, float]:
+    if isinstance(sample, list):
+        sample = _unwrap1(sample, "type=9 (tension) espera x o [x]")
+    return {"tension_kpa": float(sample) / 10.0}
+
+
+# typeCode -> decoder; una sola búsqueda por muestra en lugar de la cadena de ifs.
+_DECODERS: Dict[int, Callable[[Any], Dict[str, float]]] = {
+    1: _decode_npk,
+    2: _decode_soil,
+    3: _decode_fert,
+    4: _decode_hygro,
+    5: _decode_leaf,
+    6: _decode_rain,
+    7: _decode_thermal,
+    8: _decode_orp,
+    9: _decode_tension,
+}
+
+# Todas las métricas que producen los decoders.
+METRIC_KEYS = frozenset({
+    "nitrogen_mgkg", "phosphorus_mgkg", "potassium_mgkg",
+    "vwc_percent",
+    "ec_mscm", "solution_temp_c",
+    "air_temp_c", "rh_percent",
+    "wet", "wet_duration_s", "leaf_moist_pct",
+    "rainfall_mm", "intensity_mm_h",
+    "temperature_c",
+    "orp_mv",
+    "tension_kpa",
+})
+# set(merge=True) no expande claves con punto: las lecturas escritas antes del mapa anidado
+# tienen campos literales `values.<k>` en la raíz. Para proyectarlos hay que citarlos.
+LEGACY_VALUE_FIELDS = {k: FieldPath(f"values.{k}").to_api_repr() for k in sorted(METRIC_KEYS)}
+
+
+def _decoder(type_code: int) -> Callable[[Any], Dict[str, float]]:
+    fn = _DECODERS.get(type_code)
+    if fn is None:
+        raise HTTPException(status_code=400, detail=f"type no soportado: {type_code}")
+    return fn
+
+
+def decode_samples(type_code: int, samples: List[Any]) -> List[Dict[str, float]]:
+    # Todas las muestras de un item: el decoder se resuelve una vez, no por muestra.
+    fn = _decoder(type_code)
+    return [fn(smp) for smp in samples]
 
 
 # ---------- DEVICE RESOLUTION / SENSOR MAP ----------
-def resolve_tenant(device_id: str) -> str:
+# deviceId -> tenantId por worker. Solo cambia al re-provisionar; el TTL permite que se note.
+_tenant_cache: TTLCache = TTLCache(maxsize=10000, ttl=3600)
+# (tenantId, deviceId) -> sensorMap. Cambia al dar de alta sensores, así que TTL corto.
+_sensor_map_cache: TTLCache = TTLCache(maxsize=10000, ttl=300)
+
+
+def invalidate_device_cache(device_id: Optional[str] = None) -> int:
+    """Olvida tenant y sensorMap de un dispositivo (o de todos); devuelve cuántas entradas."""
+    if device_id is None:
+        n = len(_tenant_cache) + len(_sensor_map_cache)
+        _tenant_cache.clear()
+        _sensor_map_cache.clear()
+        return n
+    keys = [k for k in list(_sensor_map_cache.keys()) if k[1] == device_id]
+    for k in keys:
+        _sensor_map_cache.pop(k, None)
+    return len(keys) + (1 if _tenant_cache.pop(device_id, None) is not None else 0)
+
+
+async def resolve_tenant(device_id: str, allow_discover: bool = False) -> str:
+    cached = _tenant_cache.get(device_id)
+    if cached is not None:
+        return cached
+
     idx_ref = db.document(f"deviceIndex/{device_id}")
-    idx_snap = idx_ref.get()
+    idx_snap = await idx_ref.get()
     if idx_snap.exists:
         d = idx_snap.to_dict() or {}
         tid = d.get("tenantId")
         if tid:
+            _tenant_cache[device_id] = tid
             return tid
 
-    docs = list(
-        db.collection_group("sensors")
-          .where("hardwareId", "==", device_id)
-          .limit(20)
-          .stream()
-    )
-    if not docs:
-        docs = list(
-            db.collection_group("sensors")
-              .where("deviceId", "==", device_id)
-              .limit(20)
-              .stream()
+    # Sin deviceIndex, el descubrimiento recorre `sensors` de todos los tenants: solo a petición.
+    if not allow_discover:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Dispositivo sin deviceIndex: {device_id}. Provisiónalo con GET /devices/{device_id}/resolve?allow_discover=true",
         )
-    if not docs:
+
+    # Ambas variantes en paralelo; `hardwareId` tiene prioridad como antes.
+    by_hw, by_dev = await asyncio.gather(
+        first_doc(db.collection_group("sensors").where("hardwareId", "==", device_id)),
+        first_doc(db.collection_group("sensors").where("deviceId", "==", device_id)),
+    )
+    doc = by_hw or by_dev
+    if doc is None:
+        _tenant_cache.pop(device_id, None)
         raise HTTPException(status_code=404, detail=f"Dispositivo no registrado: {device_id}")
 
-    parts = docs[0].reference.path.split("/")
+    parts = doc.reference.path.split("/")
     tenant_id = parts[1]
 
-    idx_ref.set({"tenantId": tenant_id, "updatedAt": firestore.SERVER_TIMESTAMP}, merge=True)
+    await throttle_writes()
+    await idx_ref.set({"tenantId": tenant_id, "updatedAt": firestore.SERVER_TIMESTAMP}, merge=True)
+    _tenant_cache[device_id] = tenant_id
     return tenant_id
 
 
+@lru_cache(maxsize=1024)
 def get_device_ref(tenant_id: str, device_id: str):
     return db.document(f"tenants/{tenant_id}/devices/{device_id}")
 
 
-def get_or_build_sensor_map(tenant_id: str, device_id: str) -> Dict[int, str]:
-    device_ref = get_device_ref(tenant_id, device_id)
-    device_snap = device_ref.get()
-    if device_snap.exists:
-        d = device_snap.to_dict() or {}
-        sm = d.get("sensorMap")
-        if isinstance(sm, dict) and sm:
-            out = {}
-            for k, v in sm.items():
-                try:
-                    out[int(k)] = str(v)
-                except Exception:
-                    continue
-            if out:
-                return out
+def parse_sensor_map(sm: Any) -> Dict[int, str]:
+    out: Dict[int, str] = {}
+    if isinstance(sm, dict):
+        for k, v in sm.items():
+            try:
+                out[int(k)] = str(v)
+            except Exception:
+                continue
+    return out
+
 
+async def get_or_build_sensor_map(tenant_id: str, device_id: str) -> Dict[int, str]:
+    # Precedencia: el sensorMap del documento del dispositivo manda, luego deviceIndex y por
+    # último se reconstruye desde los sensores. El ingest lee deviceIndex primero (ver
+    # resolve_tenant_and_map), así que si el del dispositivo difiere se copia al índice.
+    device_ref = get_device_ref(tenant_id, device_id)
     idx_ref = db.document(f"deviceIndex/{device_id}")
-    idx_snap = idx_ref.get()
-    if idx_snap.exists:
-        d = idx_snap.to_dict() or {}
-        sm = d.get("sensorMap")
-        if isinstance(sm, dict) and sm:
-            out = {}
-            for k, v in sm.items():
-                try:
-                    out[int(k)] = str(v)
-                except Exception:
-                    continue
-            if out:
-                return out
+    device_snap, idx_snap = await asyncio.gather(device_ref.get(), idx_ref.get())
+    idx_map = parse_sensor_map((idx_snap.to_dict() or {}).get("sensorMap")) if idx_snap.exists else {}
 
-    sensors = list(
-        db.collection(f"tenants/{tenant_id}/sensors")
+    if device_snap.exists:
+        out = parse_sensor_map((device_snap.to_dict() or {}).get("sensorMap"))
+        if out:
+            if out != idx_map:
+                await throttle_writes(1)
+                # merge por campos: `sensorMap` se reemplaza entero (merge=True conservaría claves viejas).
+                await idx_ref.set(
+                    {"tenantId": tenant_id, "sensorMap": {str(k): v for k, v in out.items()}, "updatedAt": firestore.SERVER_TIMESTAMP},
+                    merge=["tenantId", "sensorMap", "updatedAt"],
+                )
+                _sensor_map_cache[(tenant_id, device_id)] = out
+            return out
+
+    if idx_map:
+        return idx_map
+
+    sensors = [
+        s async for s in db.collection(f"tenants/{tenant_id}/sensors")
           .where("hardwareId", "==", device_id)
           .stream()
-    )
+    ]
     if not sensors:
-        sensors = list(
-            db.collection(f"tenants/{tenant_id}/sensors")
+        sensors = [
+            s async for s in db.collection(f"tenants/{tenant_id}/sensors")
               .where("deviceId", "==", device_id)
               .stream()
-        )
+        ]
 
     if not sensors:
         raise HTTPException(status_code=404, detail=f"No hay sensores asociados a deviceId={device_id} en tenant={tenant_id}")
@@ -307,57 +670,318 @@ def get_or_build_sensor_map(tenant_id: str, device_id: str) -> Dict[int, str]:
     if not sensor_map:
         raise HTTPException(status_code=400, detail=f"No se pudo construir sensorMap para deviceId={device_id}. Falta telemetry.typeCode en sensores.")
 
-    device_ref.set({"sensorMap": {str(k): v for k, v in sensor_map.items()}, "updatedAt": firestore.SERVER_TIMESTAMP}, merge=True)
-    idx_ref.set({"tenantId": tenant_id, "sensorMap": {str(k): v for k, v in sensor_map.items()}, "updatedAt": firestore.SERVER_TIMESTAMP}, merge=True)
+    sm_str = {str(k): v for k, v in sensor_map.items()}
+    await throttle_writes(2)
+    await asyncio.gather(
+        device_ref.set({"sensorMap": sm_str, "updatedAt": firestore.SERVER_TIMESTAMP}, merge=True),
+        idx_ref.set({"tenantId": tenant_id, "sensorMap": sm_str, "updatedAt": firestore.SERVER_TIMESTAMP}, merge=True),
+    )
 
     return sensor_map
 
 
+async def resolve_tenant_and_map(device_id: str, allow_discover: bool = False) -> Tuple[str, Dict[int, str]]:
+    tid = _tenant_cache.get(device_id)
+    if tid is not None:
+        sensor_map = _sensor_map_cache.get((tid, device_id))
+        if sensor_map is not None:
+            return tid, sensor_map
+
+    # deviceIndex guarda tenantId y sensorMap juntos (ver get_or_build_sensor_map): una
+    # sola lectura cubre el caso normal. Si falta algo, la resolución completa de siempre.
+    # Aquí deviceIndex.sensorMap tiene precedencia sobre el del documento del dispositivo;
+    # get_or_build_sensor_map (y /devices/{id}/resolve) lo sincroniza cuando difieren, y
+    # quien edite el sensorMap del dispositivo debe actualizar también deviceIndex.
+    idx_snap = await db.document(f"deviceIndex/{device_id}").get()
+    d = (idx_snap.to_dict() or {}) if idx_snap.exists else {}
+    tid = d.get("tenantId")
+    sensor_map = None
+    if tid:
+        _tenant_cache[device_id] = tid
+        sensor_map = parse_sensor_map(d.get("sensorMap"))
+
+    tenant_id = tid or await resolve_tenant(device_id, allow_discover)
+    if not sensor_map:
+        sensor_map = await get_or_build_sensor_map(tenant_id, device_id)
+    _sensor_map_cache[(tenant_id, device_id)] = sensor_map
+    return tenant_id, sensor_map
+
+
 # ---------- DAILY AGG ----------
-@firestore.transactional
-def tx_apply_daily_agg(transaction: firestore.Transaction, agg_ref, day_ts: datetime, updates: Dict[str, Any]):
-    snap = transaction.get(agg_ref)
-    doc = snap.to_dict() if snap.exists else {"day": day_ts, "metrics": {}, "seen": {}}
-    doc.setdefault("day", day_ts)
-    doc.setdefault("metrics", {})
-    doc.setdefault("seen", {})
+def agg_add(stats: Dict[str, Dict[str, Any]], values: Dict[str, float]) -> None:
+    for k, v in values.items():
+        cur = stats.get(k)
+        if cur is None:
+            stats[k] = {"min": v, "max": v, "sum": v, "count": 1}
+            continue
+        if v < cur["min"]:
+            cur["min"] = v
+        if v > cur["max"]:
+            cur["max"] = v
+        cur["sum"] += v
+        cur["count"] += 1
 
-    seen: Dict[str, bool] = doc["seen"]
-    metrics: Dict[str, Dict[str, Any]] = doc["metrics"]
 
-    metrics_by_reading: Dict[str, Dict[str, float]] = updates["_metricsByReading"]
+def agg_columns(cols: Dict[str, List[float]]) -> Dict[str, Dict[str, Any]]:
+    # Una columna por métrica: min/max/sum en C en lugar de agg_add muestra a muestra.
+    return {k: {"min": min(c), "max": max(c), "sum": sum(c), "count": len(c)} for k, c in cols.items()}
 
-    for reading_id, values in metrics_by_reading.items():
-        if seen.get(reading_id):
+
+def agg_merge(metrics: Dict[str, Dict[str, Any]], stats: Dict[str, Dict[str, Any]]) -> None:
+    for k, d in stats.items():
+        cur = metrics.get(k)
+        if not cur:
+            metrics[k] = dict(d)
             continue
+        cur["min"] = min(float(cur.get("min", d["min"])), d["min"])
+        cur["max"] = max(float(cur.get("max", d["max"])), d["max"])
+        cur["sum"] = float(cur.get("sum", 0.0)) + d["sum"]
+        cur["count"] = int(cur.get("count", 0)) + d["count"]
+
+
+# (tenant, sensor, día) -> reading_ids ya confirmados en dailyAgg por este worker. Un batch
+# reintentado cuyas lecturas están todas aquí no abre transacción; lo que no aparece (otro
+# worker, entrada expulsada) lo sigue resolviendo el `seen` del documento.
+_agg_seen: LRUCache = LRUCache(maxsize=4096)
+
+
+def agg_seen_ids(tenant_id: str, sensor_doc_id: str, did: str) -> Set[str]:
+    key = (tenant_id, sensor_doc_id, did)
+    ids = _agg_seen.get(key)
+    if ids is None:
+        ids = _agg_seen[key] = set()
+    return ids
+
+
+def merge_daily_agg(
+    doc: Optional[Dict[str, Any]],
+    day_ts: datetime,
+    readings: Dict[str, Dict[str, float]],
+    stats: Optional[Dict[str, Dict[str, Any]]],
+) -> Optional[Dict[str, Any]]:
+    """Update (merge=True) que aplica `readings` sobre un día; None si no hay nada nuevo.
+
+    `doc` es la proyección leída en la transacción: `seen.<id>` de estas lecturas y
+    `metrics.<k>.min/max`. sum/count van como Increment, sin leer el valor actual.
+    """
+    doc = doc or {}
+    seen: Dict[str, bool] = doc.get("seen") or {}
+    metrics: Dict[str, Dict[str, Any]] = doc.get("metrics") or {}
+
+    new_ids = [rid for rid in readings if not seen.get(rid)]
+    if not new_ids:
+        return None
+
+    if stats is None or len(new_ids) != len(readings):
+        # Parte del batch ya estaba contada (reintento del cliente): agregar solo lo nuevo.
+        stats = {}
+        for rid in new_ids:
+            agg_add(stats, readings[rid])
+
+    upd_metrics: Dict[str, Dict[str, Any]] = {}
+    for k, d in stats.items():
+        cur = metrics.get(k) or {}
+        upd_metrics[k] = {
+            "min": min(float(cur.get("min", d["min"])), d["min"]),
+            "max": max(float(cur.get("max", d["max"])), d["max"]),
+            "sum": firestore.Increment(d["sum"]),
+            "count": firestore.Increment(d["count"]),
+        }
+
+    return {
+        "day": day_ts,
+        "metrics": upd_metrics,
+        "seen": {rid: True for rid in new_ids},
+        "updatedAt": firestore.SERVER_TIMESTAMP,
+    }
+
+
+# (agg_ref, día, readings, stats pre-agregados o None)
+DailyAggJob = Tuple[Any, datetime, Dict[str, Dict[str, float]], Optional[Dict[str, Dict[str, Any]]]]
+
 
-        seen[reading_id] = True
+def daily_agg_mask(jobs: List[DailyAggJob]) -> List[str]:
+    # Solo lo que el merge necesita; ni el `seen` completo del día ni sum/count.
+    paths = set()
+    for _ref, _day, readings, _stats in jobs:
+        for rid, values in readings.items():
+            paths.add(FieldPath("seen", rid).to_api_repr())
+            for k in values:
+                paths.add(FieldPath("metrics", k, "min").to_api_repr())
+                paths.add(FieldPath("metrics", k, "max").to_api_repr())
+    return sorted(paths)
 
-        for k, v in values.items():
-            cur = metrics.get(k) or {"min": v, "max": v, "sum": 0.0, "count": 0}
-            cur["min"] = min(float(cur.get("min", v)), v)
-            cur["max"] = max(float(cur.get("max", v)), v)
-            cur["sum"] = float(cur.get("sum", 0.0)) + float(v)
-            cur["count"] = int(cur.get("count", 0)) + 1
-            metrics[k] = cur
 
-    doc["metrics"] = metrics
-    doc["seen"] = seen
-    doc["updatedAt"] = firestore.SERVER_TIMESTAMP
-    transaction.set(agg_ref, doc, merge=True)
+@firestore.async_transactional
+async def tx_apply_daily_agg(transaction: firestore.AsyncTransaction, jobs: List[DailyAggJob]):
+    # Todos los días de un sensor en una transacción: una lectura get_all (proyectada) y
+    # un commit. `stats` llega pre-agregado para que un reintento por contención solo
+    # repita el merge O(#métricas), no el recorrido de muestras.
+    refs = [job[0] for job in jobs]
+    snaps = {
+        s.reference.path: s
+        async for s in db.get_all(refs, field_paths=daily_agg_mask(jobs), transaction=transaction)
+    }
+    for agg_ref, day_ts, readings, stats in jobs:
+        snap = snaps.get(agg_ref.path)
+        update = merge_daily_agg(snap.to_dict() if snap is not None and snap.exists else None, day_ts, readings, stats)
+        if update is not None:
+            transaction.set(agg_ref, update, merge=True)
+
+
+AggKey = Tuple[str, str, str]
+
+
+class DailyAggCombiner:
+    """Agrupa los deltas de dailyAgg de todos los requests y los aplica en segundo plano."""
+
+    def __init__(self, flush_sec: float, max_pending: int, max_buffered: int):
+        self.flush_sec = flush_sec
+        self.max_pending = max_pending
+        self.max_buffered = max_buffered
+        self._pending: Dict[AggKey, Dict[str, Any]] = {}
+        self._n_pending = 0
+        # Deltas cuya transacción falló, a la espera de `retryAt`. No se descartan nunca:
+        # las lecturas ya están escritas y sin el delta dailyAgg quedaría desfasado.
+        self._retry: Dict[AggKey, Dict[str, Any]] = {}
+        self._n_retry = 0
+        self._wake = asyncio.Event()
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _put(
+        bufs: Dict[AggKey, Dict[str, Any]],
+        key: AggKey,
+        readings: Dict[str, Dict[str, float]],
+        stats: Optional[Dict[str, Dict[str, Any]]],
+        attempts: int,
+    ) -> int:
+        # Mezcla un delta en `bufs`; devuelve cuántas lecturas nuevas añade.
+        buf = bufs.get(key)
+        if buf is None:
+            bufs[key] = {"readings": dict(readings), "stats": stats, "attempts": attempts}
+            return len(readings)
+        cur = buf["readings"]
+        if buf["stats"] is not None and stats is not None and cur.keys().isdisjoint(readings):
+            agg_merge(buf["stats"], stats)
+        else:
+            buf["stats"] = None
+        before = len(cur)
+        cur.update(readings)
+        buf["attempts"] = max(buf["attempts"], attempts)
+        return len(cur) - before
+
+    def add(
+        self,
+        key: AggKey,
+        readings: Dict[str, Dict[str, float]],
+        stats: Optional[Dict[str, Dict[str, Any]]],
+    ) -> None:
+        self._n_pending += self._put(self._pending, key, readings, stats, 0)
+        if self._n_pending >= self.max_pending:
+            self._wake.set()
+
+    def full(self) -> bool:
+        """Hay demasiadas lecturas sin aplicar (p. ej. Firestore caído): el ingest debe esperar."""
+        return self._n_pending + self._n_retry >= self.max_buffered
+
+    def _retry_later(self, key: AggKey, buf: Dict[str, Any]) -> None:
+        attempts = buf["attempts"] + 1
+        self._n_retry += self._put(self._retry, key, buf["readings"], buf["stats"], attempts)
+        delay = min(DAILY_AGG_RETRY_MAX_SEC, DAILY_AGG_RETRY_BASE_SEC * 2 ** (attempts - 1))
+        entry = self._retry[key]
+        entry["retryAt"] = max(entry.get("retryAt", 0.0), asyncio.get_running_loop().time() + delay)
+
+    async def flush(self, force: bool = False) -> None:
+        now = asyncio.get_running_loop().time()
+        due = [key for key, buf in self._retry.items() if force or buf["retryAt"] <= now]
+        if not self._pending and not due:
+            return
+        pending, self._pending, self._n_pending = self._pending, {}, 0
+        for key in due:
+            buf = self._retry.pop(key)
+            self._n_retry -= len(buf["readings"])
+            self._put(pending, key, buf["readings"], buf["stats"], buf["attempts"])
+
+        # Una transacción por (tenant, sensor) con todos sus días acumulados desde el último
+        # flush; los sensores van en paralelo.
+        by_sensor: DefaultDict[Tuple[str, str], List[AggKey]] = defaultdict(list)
+        for key in pending:
+            by_sensor[(key[0], key[1])].append(key)
+
+        coros = []
+        for (tenant_id, sensor_doc_id), keys in by_sensor.items():
+            agg_col = db.collection(f"tenants/{tenant_id}/sensors/{sensor_doc_id}/dailyAgg")
+            jobs: List[DailyAggJob] = []
+            for key in keys:
+                did = key[2]
+                buf = pending[key]
+                day_ts = day_start_utc(datetime.strptime(did, "%Y%m%d").replace(tzinfo=timezone.utc))
+                jobs.append((agg_col.document(did), day_ts, buf["readings"], buf["stats"]))
+            coros.append(tx_apply_daily_agg(db.transaction(), jobs))
+
+        await throttle_writes(len(pending))
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        for (tenant_id, sensor_doc_id), keys, res in zip(by_sensor.keys(), by_sensor.values(), results):
+            if not isinstance(res, BaseException):
+                for key in keys:
+                    agg_seen_ids(*key).update(pending[key]["readings"])
+                invalidate_sensor_responses(tenant_id, sensor_doc_id)
+                continue
+            for key in keys:
+                buf = pending[key]
+                logger.warning("dailyAgg %s/%s/%s falló (intento %d); se reintenta", *key, buf["attempts"] + 1, exc_info=res)
+                # `seen` hace idempotente el reintento aunque la transacción llegara a confirmarse.
+                self._retry_later(key, buf)
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("flush de dailyAgg falló")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._closing = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        # Al cerrar se reintenta todo sin esperar al backoff; lo que aún falle se pierde.
+        await self.flush(force=True)
+        if self._retry:
+            logger.error("dailyAgg: %d días (%d lecturas) sin aplicar al cerrar", len(self._retry), self._n_retry)
+
+
+daily_agg_combiner = DailyAggCombiner(DAILY_AGG_FLUSH_SEC, DAILY_AGG_MAX_PENDING, DAILY_AGG_MAX_BUFFERED)
 
 
 # ---------- INGEST (COMPACT BATCH) ----------
-def ingest_compact_batch(payload: CompactBatchTelemetry):
+async def ingest_compact_batch(payload: CompactBatchTelemetry, allow_discover: bool = False):
     if not payload.it:
         raise HTTPException(status_code=400, detail="it vacío")
 
     if len(payload.it) > MAX_ITEMS_PER_BATCH:
         raise HTTPException(status_code=400, detail=f"Máximo {MAX_ITEMS_PER_BATCH} items por batch")
 
+    if daily_agg_combiner.full():
+        # dailyAgg no se puede aplicar (Firestore caído o saturado): que el dispositivo reintente
+        # en vez de escribir lecturas cuyo agregado no cabe en memoria.
+        raise HTTPException(status_code=503, detail="dailyAgg saturado; reintenta el batch")
+
     device_id = payload.i
-    tenant_id = resolve_tenant(device_id)
-    sensor_map = get_or_build_sensor_map(tenant_id, device_id)
+    tenant_id, sensor_map = await resolve_tenant_and_map(device_id, allow_discover)
 
     now = datetime.now(timezone.utc)
 
@@ -370,30 +994,37 @@ def ingest_compact_batch(payload: CompactBatchTelemetry):
     lat = (float(payload.la) / 1e6) if payload.la is not None else None
     lon = (float(payload.lo) / 1e6) if payload.lo is not None else None
 
-    meta_base = {
-        "deviceId": device_id,
-        "intervalSec": interval,
-        "batteryPct": battery_pct,
-        "rssi": rssi_dbm,
-        "lat": lat,
-        "lon": lon,
-    }
+    meta_base = None
+    if EMBED_META_PER_READING:
+        meta_base = {
+            "deviceId": device_id,
+            "intervalSec": interval,
+            "batteryPct": battery_pct,
+            "rssi": rssi_dbm,
+            "lat": lat,
+            "lon": lon,
+        }
 
-    b = db.batch()
+    ops: List[WriteOp] = []
 
     dev_ref = get_device_ref(tenant_id, device_id)
+    # Batería/señal/posición/intervalo se guardan una vez por batch aquí, no en cada lectura.
     dev_status_update = {
         "status.lastSeenAt": now,
         "status.batteryPct": battery_pct,
         "status.rssi": rssi_dbm,
+        "status.intervalSec": interval,
     }
     if lat is not None and lon is not None:
         dev_status_update["status.lastLat"] = lat
         dev_status_update["status.lastLon"] = lon
 
-    b.set(dev_ref, dev_status_update, merge=True)
+    ops.append(("set", dev_ref, dev_status_update))
 
-    daily_by_sensor: Dict[str, Dict[str, Dict[str, Dict[str, float]]]] = {}
+    # sensor -> día -> {"readings": {reading_id: values}, "cols": {métrica: [valores]}}
+    daily_by_sensor: DefaultDict[str, DefaultDict[str, Dict[str, Any]]] = defaultdict(
+        lambda: defaultdict(lambda: {"readings": {}, "cols": {}})
+    )
 
     ingested_total = 0
     sensors_touched: List[str] = []
@@ -409,48 +1040,75 @@ def ingest_compact_batch(payload: CompactBatchTelemetry):
 
         sensor_doc_id = sensor_map.get(type_code)
         if not sensor_doc_id:
+            # El sensorMap cacheado puede ser anterior al alta del sensor: que el reintento relea.
+            invalidate_device_cache(device_id)
             raise HTTPException(
                 status_code=404,
                 detail=f"No hay sensor asignado para typeCode={type_code} en deviceId={device_id}. Revisa telemetry.typeCode en Firestore."
             )
 
         sensor_ref = db.document(f"tenants/{tenant_id}/sensors/{sensor_doc_id}")
+        readings_col = sensor_ref.collection("readings")
+        # Un único dict por item, compartido por todas sus lecturas.
+        item_meta = {**meta_base, "typeCode": type_code} if meta_base is not None else None
         sensors_touched.append(sensor_doc_id)
 
         n = len(samples)
         last_ts = None
         last_values = None
 
-        for i, smp in enumerate(samples):
-            ts = now - timedelta(seconds=(n - 1 - i) * interval)
-            values = values_from_compact(type_code, smp)
-
+        # Un único datetime base que avanza `step` por muestra; el id se formatea a mano
+        # (strftime es ~3x más lento).
+        step = timedelta(seconds=interval)
+        ts = now - (n - 1) * step
+        sensor_days = daily_by_sensor[sensor_doc_id]
+        # El día (id y su acumulador) solo se recalcula al cruzar medianoche.
+        day_end = ts
+        did = ""
+        day: Dict[str, Any] = {}
+
+        for values in decode_samples(type_code, samples):
             last_ts = ts
             last_values = values
 
-            reading_id = ts.strftime("%Y%m%d%H%M")
-            reading_ref = db.document(f"tenants/{tenant_id}/sensors/{sensor_doc_id}/readings/{reading_id}")
+            if ts >= day_end:
+                day_end = day_start_utc(ts) + ONE_DAY
+                did = f"{ts.year:04d}{ts.month:02d}{ts.day:02d}"
+                day = sensor_days[did]
 
-            expires_at = ts + timedelta(days=RAW_RETENTION_DAYS)
+            reading_id = f"{did}{ts.hour:02d}{ts.minute:02d}"
+            reading_ref = readings_col.document(reading_id)
 
+            expires_at = ts + RAW_RETENTION
+
+            # Solo lo propio de la muestra; `expiresAt` lo consume la política TTL de Firestore.
+            # `values` es un mapa anidado; las lecturas anteriores tienen campos literales
+            # `values.<k>` en la raíz (ver LEGACY_VALUE_FIELDS) y caducan en RAW_RETENTION_DAYS.
             data: Dict[str, Any] = {
                 "ts": ts,
-                "updatedAt": firestore.SERVER_TIMESTAMP,
-                "meta": meta_base,
                 "expiresAt": expires_at,
-                "meta.typeCode": type_code,
+                "values": values,
             }
-            for k, v in values.items():
-                data[f"values.{k}"] = float(v)
-
-            b.set(reading_ref, data, merge=True)
-
-            did = day_id(ts)
-            daily_by_sensor.setdefault(sensor_doc_id, {})
-            daily_by_sensor[sensor_doc_id].setdefault(did, {})
-            daily_by_sensor[sensor_doc_id][did][reading_id] = values
+            if item_meta is not None:
+                data["meta"] = item_meta
+
+            ops.append(("set", reading_ref, data))
+
+            cols = day["cols"]
+            if reading_id in day["readings"]:
+                # Minuto repetido en el mismo batch: la transacción recalcula desde `readings`.
+                day["cols"] = None
+            elif cols is not None:
+                for k, v in values.items():
+                    col = cols.get(k)
+                    if col is None:
+                        cols[k] = [v]
+                    else:
+                        col.append(v)
+            day["readings"][reading_id] = values
 
             ingested_total += 1
+            ts += step
 
         sensor_update: Dict[str, Any] = {
             "status.batteryPct": battery_pct,
@@ -464,18 +1122,34 @@ def ingest_compact_batch(payload: CompactBatchTelemetry):
             sensor_update["status.lastLat"] = lat
             sensor_update["status.lastLon"] = lon
 
-        b.set(sensor_ref, sensor_update, merge=True)
+        ops.append(("set", sensor_ref, sensor_update))
+
+    # Una sola muestra (dispositivos que envían una por intervalo): dispositivo, lectura y sensor.
+    write = direct_write if len(ops) <= DIRECT_WRITE_MAX_OPS else batch_write
+    failures = await write(ops)
+    if failures:
+        logger.error("ingest %s: %d escrituras fallidas: %s", device_id, len(failures), failures[:5])
+        raise HTTPException(status_code=503, detail=f"Fallaron {len(failures)} escrituras; reintenta el batch")
 
-    b.commit()
+    for sensor_doc_id in daily_by_sensor:
+        invalidate_sensor_responses(tenant_id, sensor_doc_id)
 
-    updated_days = []
+    queued_days = []
+    deduped_days = 0
     for sensor_doc_id, days_map in daily_by_sensor.items():
-        for did, readings_map in days_map.items():
-            day_ts = day_start_utc(datetime.strptime(did, "%Y%m%d").replace(tzinfo=timezone.utc))
-            agg_ref = db.document(f"tenants/{tenant_id}/sensors/{sensor_doc_id}/dailyAgg/{did}")
-            tx = db.transaction()
-            tx_apply_daily_agg(tx, agg_ref, day_ts, {"_metricsByReading": readings_map})
-            updated_days.append({"sensorDocId": sensor_doc_id, "day": did})
+        for did, day in days_map.items():
+            seen_ids = agg_seen_ids(tenant_id, sensor_doc_id, did)
+            readings = day["readings"]
+            stats = agg_columns(day["cols"]) if day["cols"] is not None else None
+            if seen_ids:
+                fresh = {rid: v for rid, v in readings.items() if rid not in seen_ids}
+                if not fresh:
+                    deduped_days += 1
+                    continue
+                if len(fresh) != len(readings):
+                    readings, stats = fresh, None
+            daily_agg_combiner.add((tenant_id, sensor_doc_id, did), readings, stats)
+            queued_days.append({"sensorDocId": sensor_doc_id, "day": did})
 
     return {
         "status": "success",
@@ -483,23 +1157,43 @@ def ingest_compact_batch(payload: CompactBatchTelemetry):
         "deviceId": device_id,
         "ingestedReadings": ingested_total,
         "sensorsTouched": list(sorted(set(sensors_touched))),
-        "updatedDailyAgg": updated_days[:50],
+        "queuedDailyAgg": queued_days[:50],
+        # Clave histórica (flujos de Node-RED): mismos días, ahora aplicados en diferido.
+        "updatedDailyAgg": queued_days[:50],
+        "dedupedDailyAgg": deduped_days,
     }
 
 
 # ---------- POST: single endpoint ----------
+# El cuerpo se decodifica y valida con msgspec, sin pasar por el json de la stdlib ni por pydantic.
 @app.post("/telemetry/batch")
-def post_telemetry_batch(data: CompactBatchTelemetry, _: None = Depends(verify_api_key)):
-    return ingest_compact_batch(data)
+async def post_telemetry_batch(
+    request: Request,
+    allow_discover: bool = Query(False),
+    _: None = Depends(verify_api_key),
+):
+    try:
+        data = _batch_decoder.decode(await request.body())
+    except msgspec.ValidationError as e:
+        raise RequestValidationError([{"type": "value_error", "loc": ("body",), "msg": str(e)}])
+    except msgspec.DecodeError:
+        raise HTTPException(status_code=400, detail="JSON inválido")
+    return await ingest_compact_batch(data, allow_discover)
 
 
 # ---------- GET: resolve ----------
 @app.get("/devices/{device_id}/resolve")
-def get_device_resolve(device_id: str, _: None = Depends(verify_api_key)):
-    tenant_id = resolve_tenant(device_id)
+async def get_device_resolve(
+    device_id: str,
+    allow_discover: bool = Query(False),
+    _: None = Depends(verify_api_key),
+):
+    tenant_id = await resolve_tenant(device_id, allow_discover)
     dev_ref = get_device_ref(tenant_id, device_id)
-    dev_snap = dev_ref.get()
-    sensor_map = get_or_build_sensor_map(tenant_id, device_id)
+    dev_snap, sensor_map = await asyncio.gather(
+        dev_ref.get(),
+        get_or_build_sensor_map(tenant_id, device_id),
+    )
 
     return {
         "deviceId": device_id,
@@ -511,23 +1205,21 @@ def get_device_resolve(device_id: str, _: None = Depends(verify_api_key)):
 
 # ---------- GET: config ----------
 @app.get("/devices/{device_id}/config")
-def get_device_config(device_id: str, _: None = Depends(verify_api_key)):
-    tenant_id = resolve_tenant(device_id)
+async def get_device_config(device_id: str, _: None = Depends(verify_api_key)):
+    tenant_id = await resolve_tenant(device_id)
     dev_ref = get_device_ref(tenant_id, device_id)
-    snap = dev_ref.get()
+    snap = await dev_ref.get()
 
-    out_cfg = {
-        "intervalSec": SAMPLE_INTERVAL_SEC_DEFAULT,
-        "samplesPerBatch": SAMPLES_PER_BATCH_DEFAULT,
-        "schedule": []
-    }
+    interval_sec = SAMPLE_INTERVAL_SEC_DEFAULT
+    samples_per_batch = SAMPLES_PER_BATCH_DEFAULT
+    schedule: List[ScheduleItem] = []
 
     if snap.exists:
         d = snap.to_dict() or {}
         tc = (d.get("telemetryConfig") or {})
         if isinstance(tc, dict):
-            out_cfg["intervalSec"] = int(tc.get("intervalSec", out_cfg["intervalSec"]))
-            out_cfg["samplesPerBatch"] = int(tc.get("samplesPerBatch", out_cfg["samplesPerBatch"]))
+            interval_sec = int(tc.get("intervalSec", interval_sec))
+            samples_per_batch = int(tc.get("samplesPerBatch", samples_per_batch))
             sch = tc.get("schedule", [])
             if isinstance(sch, list):
                 norm = []
@@ -545,8 +1237,16 @@ def get_device_config(device_id: str, _: None = Depends(verify_api_key)):
                         warm = 0
                     if warm > 60000:
                         warm = 60000
-                    norm.append({"sensorId": sid, "rail": rail, "warmupMs": warm})
-                out_cfg["schedule"] = norm
+                    norm.append(ScheduleItem.model_construct(sensorId=sid, rail=rail, warmupMs=warm))
+                schedule = norm
+
+    # model_construct sin validar: los valores vienen de Firestore y ya están normalizados
+    # arriba (int() y rangos). Cualquier dato no confiable debe pasar por el validador.
+    out_cfg = TelemetryConfigOut.model_construct(
+        intervalSec=interval_sec,
+        samplesPerBatch=samples_per_batch,
+        schedule=schedule,
+    )
 
     return {
         "deviceId": device_id,
@@ -556,83 +1256,174 @@ def get_device_config(device_id: str, _: None = Depends(verify_api_key)):
 
 # ---------- GET: readings / dailyAgg ----------
 @app.get("/tenants/{tenant_id}/sensors/{sensor_id}/readings")
-def get_sensor_readings(
+async def get_sensor_readings(
     tenant_id: str,
     sensor_id: str,
     range: str = Query("1d"),
     limit_n: int = Query(500, ge=1, le=5000),
+    fields: Optional[str] = Query(None, description="Campos separados por coma (ts, values, values.<métrica>)"),
     _: None = Depends(verify_api_key),
 ):
+    select = parse_fields(fields, READINGS_FIELDS)
+    cache_key = ("readings", tenant_id, sensor_id, response_gen(tenant_id, sensor_id), range, limit_n, tuple(select))
+    hit = cached_response(cache_key)
+    if hit is not None:
+        return hit
+
     start, end = get_time_window(range)
     col = db.collection(f"tenants/{tenant_id}/sensors/{sensor_id}/readings")
-    q = (col.where("ts", ">=", start)
+    # Proyección en el servidor: `expiresAt` (y `meta` de lecturas antiguas) no viajan en la respuesta.
+    q = (col.select(readings_projection(select))
+           .where("ts", ">=", start)
            .where("ts", "<=", end)
            .order_by("ts", direction=firestore.Query.DESCENDING)
            .limit(limit_n))
-    rows = []
-    for s in q.stream():
-        d = s.to_dict() or {}
-        rows.append({"id": s.id, **d})
-    return {"tenantId": tenant_id, "sensorId": sensor_id, "range": range, "items": rows}
+    return await stream_items(
+        {"tenantId": tenant_id, "sensorId": sensor_id, "range": range},
+        q,
+        cache_key,
+        RESPONSE_TTL_SEC.get(range, RESPONSE_TTL_SEC_DEFAULT),
+        fold_legacy_values,
+    )
 
 @app.get("/tenants/{tenant_id}/sensors/{sensor_id}/dailyAgg")
-def get_sensor_daily_agg(
+async def get_sensor_daily_agg(
     tenant_id: str,
     sensor_id: str,
     days: int = Query(365, ge=1, le=3660),
+    fields: Optional[str] = Query(None, description="Campos separados por coma (day, metrics, metrics.<métrica>)"),
     _: None = Depends(verify_api_key),
 ):
+    select = parse_fields(fields, DAILY_AGG_FIELDS)
+    cache_key = ("dailyAgg", tenant_id, sensor_id, response_gen(tenant_id, sensor_id), days, tuple(select))
+    hit = cached_response(cache_key)
+    if hit is not None:
+        return hit
+
     end = datetime.now(timezone.utc)
     start = day_start_utc(end) - timedelta(days=days - 1)
     col = db.collection(f"tenants/{tenant_id}/sensors/{sensor_id}/dailyAgg")
-    q = (col.where("day", ">=", start)
+    # Sin `seen` (hasta 1440 ids por día), que solo sirve para la idempotencia del ingest.
+    q = (col.select(select)
+           .where("day", ">=", start)
            .order_by("day", direction=firestore.Query.ASCENDING)
            .limit(days + 10))
-    rows = []
-    for s in q.stream():
-        d = s.to_dict() or {}
-        rows.append({"id": s.id, **d})
-    return {"tenantId": tenant_id, "sensorId": sensor_id, "days": days, "items": rows}
+    return await stream_items(
+        {"tenantId": tenant_id, "sensorId": sensor_id, "days": days},
+        q,
+        cache_key,
+        DAILY_AGG_RESPONSE_TTL_SEC,
+    )
+
+# ---------- ADMIN ----------
+@app.post("/admin/cache/invalidate")
+async def post_cache_invalidate(
+    device_id: Optional[str] = Query(None),
+    _: None = Depends(verify_api_key),
+):
+    # Solo afecta al worker que atiende la petición; el resto expira por TTL.
+    return {"status": "ok", "deviceId": device_id, "evicted": invalidate_device_cache(device_id)}
+
 
 # ---------- MAINTENANCE ----------
 @app.post("/maintenance/purge-readings")
-def purge_readings(
+async def purge_readings(
     older_than_days: int = Query(30, ge=1, le=3650),
     batch_size: int = Query(500, ge=1, le=500),
+    max_deletes: int = Query(10000, ge=1, le=1000000),
+    max_rounds: int = Query(20, ge=1, le=2000),
+    cursor: Optional[datetime] = Query(None, description="`nextCursor` de una llamada anterior"),
     dry_run: bool = Query(False),
     _: None = Depends(verify_api_key),
 ):
     cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
 
-    q = (
-        db.collection_group("readings")
-          .where("ts", "<", cutoff)
-          .order_by("ts", direction=firestore.Query.ASCENDING)
-          .limit(batch_size)
-    )
-
-    snaps = list(q.stream())
-    if not snaps:
-        return {"status": "ok", "cutoff": cutoff.isoformat(), "deleted": 0}
+    range_q = db.collection_group("readings").where("ts", "<", cutoff)
+    if cursor is not None:
+        # `>=` y no `>`: lecturas con el mismo ts que quedaron sin borrar no se saltan.
+        range_q = range_q.where("ts", ">=", cursor)
+    base_q = range_q.order_by("ts", direction=firestore.Query.ASCENDING)
 
     if dry_run:
+        # Conteo por agregación en el servidor (hasta `max_deletes`), sin transferir documentos.
+        res, first, last = await asyncio.gather(
+            base_q.limit(max_deletes).count().get(),
+            first_doc(base_q),
+            first_doc(range_q.order_by("ts", direction=firestore.Query.DESCENDING)),
+        )
+        would_delete = res[0][0].value if res and res[0] else 0
         return {
             "status": "dry_run",
             "cutoff": cutoff.isoformat(),
-            "wouldDelete": len(snaps),
-            "first": snaps[0].reference.path,
-            "last": snaps[-1].reference.path,
+            "wouldDelete": would_delete,
+            "first": first.reference.path if first else None,
+            # El último solo es el del rango a borrar si el conteo no llegó a `max_deletes`.
+            "last": last.reference.path if last and would_delete < max_deletes else None,
         }
 
-    b = db.batch()
-    for s in snaps:
-        b.delete(s.reference)
-    b.commit()
-
+    # Páginas de `batch_size` con cursor: cada consulta continúa tras el último documento
+    # de la anterior en lugar de re-escanear el mismo prefijo del índice. El borrado de una
+    # página se solapa con la lectura de la siguiente.
+    last_snap = None
+    first_path = None
+    last_path = None
+    fetched = 0
+    deleted = 0
+    failed = 0
+    more = False
+    pending: Optional[asyncio.Task] = None
+    pending_n = 0
+
+    async def settle():
+        nonlocal deleted, failed, pending
+        if pending is None:
+            return
+        failures = await pending
+        pending = None
+        deleted += pending_n - len(failures)
+        failed += len(failures)
+
+    for _round in range(max_rounds):
+        page = min(batch_size, max_deletes - fetched)
+        if page <= 0:
+            more = True
+            break
+        # Solo `ts` (para el cursor y `nextCursor`): los datos de la lectura no hacen falta.
+        q = base_q.select(["ts"])
+        if last_snap is not None:
+            q = q.start_after(last_snap)
+        refs = []
+        async for s in q.limit(page).stream():
+            refs.append(s.reference)
+            last_snap = s
+        await settle()
+        if not refs:
+            break
+
+        if first_path is None:
+            first_path = refs[0].path
+        last_path = refs[-1].path
+        fetched += len(refs)
+
+        pending_n = len(refs)
+        pending = asyncio.create_task(bulk_write([("delete", ref, None) for ref in refs]))
+        if len(refs) < page:
+            break
+    else:
+        more = True
+    await settle()
+
+    if first_path is None:
+        return {"status": "ok", "cutoff": cutoff.isoformat(), "deleted": 0, "more": False, "nextCursor": None}
+
+    next_cursor = last_snap.get("ts") if more else None
     return {
-        "status": "ok",
+        "status": "partial" if failed else "ok",
         "cutoff": cutoff.isoformat(),
-        "deleted": len(snaps),
-        "first": snaps[0].reference.path,
-        "last": snaps[-1].reference.path,
+        "deleted": deleted,
+        "failed": failed,
+        "more": more,
+        "nextCursor": next_cursor.isoformat() if next_cursor else None,
+        "first": first_path,
+        "last": last_path,
     }